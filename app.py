@@ -1,17 +1,26 @@
+import copy
 import json
+import logging
 import random
+import threading
 import time
+import uuid
+from collections import deque
+from functools import partial
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 import streamlit as st
-import numpy as np
-from scipy.io.wavfile import write
-import io
-import base64
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import binascii
 from google.oauth2 import service_account
 from google.cloud import firestore
 import google.auth.transport.requests
 import traceback
 import requests
-import wave
+from requests.adapters import HTTPAdapter
+import struct
+
+logger = logging.getLogger(__name__)
 
 # --- HELPER FUNCTIONS  ---
 TEXT_GENERATION_PROMPT = """
@@ -21,56 +30,205 @@ TEXT_GENERATION_PROMPT = """
     - "questions": a list of objects, each with "text" (the question) and "correct_response" ("Yes" or "No").
 """
 
-with open("collection.json", "r", encoding="utf-8") as f:
-    available_passages = json.load(f)["passages"]
-print(available_passages)
+# Music prompt building blocks
+TEMPO_DESCRIPTIONS = {
+    "Very Slow": "very slow tempo, meditative pace",
+    "Slow": "slow tempo, relaxed pace",
+    "Moderate": "moderate tempo, steady rhythm",
+    "Fast": "fast tempo, energetic pace",
+    "Very Fast": "very fast tempo, high energy",
+}
+VOLUME_DESCRIPTIONS = {
+    "Very Quiet": "very soft and gentle, barely audible",
+    "Quiet": "soft and gentle, background ambiance",
+    "Moderate": "moderate volume, balanced dynamics",
+    "Loud": "full volume, rich and present",
+    "Very Loud": "powerful and intense, strong presence",
+}
+ALWAYS_NEGATIVE = (
+    "vocals",
+    "lyrics",
+    "singing",
+    "sudden changes",
+    "jarring transitions",
+)
+
+# Test pages that play background music
+MUSIC_PAGES = (3, 4)
+
+# Session state restored when a participant reloads the page
+PROGRESS_KEYS = (
+    "page_number",
+    "user_info",
+    "music_params",
+    "test_answers",
+    "test_content_page_2",
+    "test_content_page_3",
+    "test_content_page_4",
+)
+
+# How long, and for how many sessions, reload snapshots are kept
+PROGRESS_TTL_SECONDS = 2 * 3600
+PROGRESS_MAX_ENTRIES = 500
+
+# Client-side pacing for Lyria predict calls, below the project's quota
+LYRIA_REQUESTS_PER_MINUTE = 10
+
+
+@st.cache_data(show_spinner=False)
+def load_passage_collection() -> list:
+    """Parse collection.json once; every caller receives its own copy."""
+    with open("collection.json", "r", encoding="utf-8") as f:
+        return json.load(f)["passages"]
+
+
+available_passages = load_passage_collection()
+logger.debug("Available passages: %s", available_passages)
 random.shuffle(available_passages)
 
 
+@st.cache_resource(show_spinner=False)
+def get_secrets(section: str) -> dict:
+    """Plain-dict snapshot of one st.secrets section, read once per process."""
+    return dict(st.secrets[section])
+
+
+@st.cache_resource(show_spinner=False)
+def get_lyria_credentials():
+    """Build the Lyria service account credentials once per server process."""
+    return service_account.Credentials.from_service_account_info(
+        get_secrets("lyria"),
+        scopes=["https://www.googleapis.com/auth/cloud-platform"],
+    )
+
+
+@st.cache_resource(show_spinner=False)
+def get_lyria_token_lock() -> threading.Lock:
+    """Lock serializing refreshes of the shared Lyria credentials."""
+    return threading.Lock()
+
+
+@st.cache_resource(show_spinner=False)
+def get_http_session() -> requests.Session:
+    """Shared HTTP session so Lyria calls reuse pooled keep-alive connections."""
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
+
+@st.cache_resource(show_spinner=False)
+def get_lyria_endpoint() -> str:
+    """Lyria predict URL for the configured project, built once per process."""
+    project_id = get_secrets("lyria")["project_id"]
+    return (
+        f"https://us-central1-aiplatform.googleapis.com/v1/projects/"
+        f"{project_id}/locations/us-central1/publishers/google/models/lyria-002:predict"
+    )
+
+
 def get_access_token_for_lyria() -> str:
-    """Get OAuth token for Lyria API using service account credentials."""
-    try:
-        # Use the same firestore credentials for Lyria API access
-        creds = service_account.Credentials.from_service_account_info(
-            st.secrets["lyria"],
-            scopes=["https://www.googleapis.com/auth/cloud-platform"],
-        )
-        req = google.auth.transport.requests.Request()
-        creds.refresh(req)
+    """
+    Get OAuth token for Lyria API, refreshing it only when close to expiry.
+    Raises on failure; it may run in the music prefetch thread, so reporting
+    is left to load_music.
+    """
+    creds = get_lyria_credentials()
+    # Sessions share the credentials, so only one of them refreshes
+    with get_lyria_token_lock():
+        if (
+            not creds.valid
+            or creds.expiry is None
+            or creds.expiry - datetime.utcnow() < timedelta(minutes=5)
+        ):
+            req = google.auth.transport.requests.Request()
+            creds.refresh(req)
         return creds.token
-    except Exception as e:
-        st.error(f"Failed to get access token: {e}")
-        return None
+
+
+@st.cache_resource(show_spinner=False)
+def get_lyria_request_log() -> tuple:
+    """Timestamps of recent Lyria requests and their lock, shared by all sessions."""
+    return deque(), threading.Lock()
+
+
+def wait_if_throttled(limit: int = LYRIA_REQUESTS_PER_MINUTE, window: float = 60):
+    """
+    Block until another Lyria request fits in the sliding-window quota, so
+    requests are paced up front instead of being rejected with a 429.
+    """
+    timestamps, lock = get_lyria_request_log()
+    while True:
+        with lock:
+            now = time.monotonic()
+            while timestamps and now - timestamps[0] >= window:
+                timestamps.popleft()
+            if len(timestamps) < limit:
+                timestamps.append(now)
+                return
+            wait = window - (now - timestamps[0])
+        logger.info("Lyria request quota reached, waiting %.1fs", wait)
+        time.sleep(wait)
+
+
+def get_retry_delay(attempt: int, response=None, cap: float = 60) -> float:
+    """
+    Exponential backoff with jitter (2, 4, 8, ... seconds) for retrying
+    Google API calls. A server-provided Retry-After header, given either as
+    seconds or as an HTTP date, takes precedence.
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "").strip()
+        if retry_after.isdigit():
+            return min(cap, float(retry_after))
+        if retry_after:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                wait = (retry_at - datetime.now(timezone.utc)).total_seconds()
+                return min(cap, max(0.0, wait))
+            except (TypeError, ValueError):
+                pass
+    return min(cap, 2**attempt + random.uniform(0, 1))
+
+
+def encode_wav(pcm, samplerate: int, nchannels: int) -> bytes:
+    """
+    Wrap 16-bit PCM in a canonical 44-byte RIFF/WAVE header. The samples are
+    copied once, into the result, instead of through a BytesIO buffer and
+    again by getvalue().
+    """
+    block_align = nchannels * 2  # 16-bit samples
+    header = struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        36 + len(pcm),
+        b"WAVE",
+        b"fmt ",
+        16,  # fmt chunk size
+        1,  # PCM
+        nchannels,
+        samplerate,
+        samplerate * block_align,  # byte rate
+        block_align,
+        16,  # bits per sample
+        b"data",
+        len(pcm),
+    )
+    return header + pcm
 
 
 def decode_prediction_to_wav_bytes(pred_bytes_b64: str) -> bytes:
     """
     Lyria predict returns raw 48kHz 16-bit PCM stereo as base64-encoded bytes.
     We wrap that raw PCM into a WAV container so media players can open it.
+    Raises binascii.Error on a malformed payload; the caller reports it.
     """
-    try:
-        raw = base64.b64decode(pred_bytes_b64)
-        pcm = np.frombuffer(raw, dtype=np.int16)
-        # Ensure even number of samples for stereo reshape
-        if pcm.size % 2 != 0:
-            pcm = pcm[:-1]
-        stereo = pcm.reshape(-1, 2)
-
-        # Build a WAV using the standard library
-        buf = io.BytesIO()
-        with wave.open(buf, "wb") as w:
-            nchannels = 2
-            sampwidth = 2  # 16-bit
-            framerate = 48000
-            nframes = stereo.shape[0]
-            w.setnchannels(nchannels)
-            w.setsampwidth(sampwidth)
-            w.setframerate(framerate)
-            w.writeframes(stereo.tobytes())
-        return buf.getvalue()
-    except Exception as e:
-        st.error(f"Error decoding audio: {e}")
-        return None
+    # a2b_base64 reads the str directly; b64decode would first copy it
+    # into an ASCII bytes object the size of the whole payload
+    raw = binascii.a2b_base64(pred_bytes_b64)
+    # Interleaved 16-bit stereo is already the WAV frame layout, so the
+    # PCM only needs trimming to whole frames (4 bytes each), as a view
+    raw = memoryview(raw)[: len(raw) - len(raw) % 4]
+    return encode_wav(raw, samplerate=48000, nchannels=2)
 
 
 def create_music_prompt(music_params: dict) -> tuple:
@@ -83,14 +241,7 @@ def create_music_prompt(music_params: dict) -> tuple:
         genre = music_params.get("genre", "ambient")
 
         # Tempo mapping
-        tempo_map = {
-            "Very Slow": "very slow tempo, meditative pace",
-            "Slow": "slow tempo, relaxed pace",
-            "Moderate": "moderate tempo, steady rhythm",
-            "Fast": "fast tempo, energetic pace",
-            "Very Fast": "very fast tempo, high energy",
-        }
-        tempo_desc = tempo_map.get(music_params.get("tempo", "Moderate"))
+        tempo_desc = TEMPO_DESCRIPTIONS.get(music_params.get("tempo", "Moderate"))
 
         # Mood mapping
         mood = music_params.get("mood", "calm")
@@ -109,14 +260,7 @@ def create_music_prompt(music_params: dict) -> tuple:
                 instrument_desc = f", featuring {', '.join(instruments[:-1]).lower()}, and {instruments[-1].lower()}"
 
         # Volume intensity mapping
-        volume_map = {
-            "Very Quiet": "very soft and gentle, barely audible",
-            "Quiet": "soft and gentle, background ambiance",
-            "Moderate": "moderate volume, balanced dynamics",
-            "Loud": "full volume, rich and present",
-            "Very Loud": "powerful and intense, strong presence",
-        }
-        volume_desc = volume_map.get(music_params.get("volume", "Moderate"))
+        volume_desc = VOLUME_DESCRIPTIONS.get(music_params.get("volume", "Moderate"))
 
         # Build main prompt
         main_prompt = f"{genre} music, {mood} and peaceful, {tempo_desc}{instrument_desc}, {volume_desc}"
@@ -146,11 +290,10 @@ def create_music_prompt(music_params: dict) -> tuple:
             negative_items.extend(["sleepy", "boring", "monotonous"])
 
         # Always exclude distracting elements for study music
-        negative_items.extend(
-            ["vocals", "lyrics", "singing", "sudden changes", "jarring transitions"]
-        )
+        negative_items.extend(ALWAYS_NEGATIVE)
 
-        negative_prompt = ", ".join(set(negative_items))  # Remove duplicates
+        # Remove duplicates, keeping order so equal params give equal prompts
+        negative_prompt = ", ".join(dict.fromkeys(negative_items))
 
         return main_prompt, negative_prompt
 
@@ -165,133 +308,196 @@ def load_passage():
     return passage["generated_text"], passage["questions"]
 
 
-def load_music(music_params: dict, max_retries=3):
+@st.cache_data(ttl=3600, max_entries=8, show_spinner=False)
+def fetch_lyria_audio(instance: dict, max_retries=3) -> tuple:
+    """
+    Call the Lyria predict endpoint and return every prediction as WAV bytes.
+    Results are cached by request in bounded memory, so pages, users and
+    reloads asking for the same music share one generation. Failures
+    raise RuntimeError with a message for the user instead of returning,
+    so that they are never cached. Nothing here calls st.*: it also runs
+    in the music prefetch thread.
+    """
+    # Get access token
+    try:
+        token = get_access_token_for_lyria()
+    except Exception as e:
+        raise RuntimeError(f"Failed to authenticate with Lyria API: {e}")
+
+    endpoint = get_lyria_endpoint()
+    payload = {"instances": [instance], "parameters": {}}
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "application/json",
+    }
+
+    # Retries are logged rather than shown: st calls inside a cached
+    # function would be replayed on every cache hit
+    for attempt in range(1, max_retries + 1):
+        wait_if_throttled()
+        try:
+            response = get_http_session().post(
+                endpoint, headers=headers, json=payload, timeout=120
+            )
+            response.raise_for_status()
+            break
+        except requests.exceptions.Timeout:
+            if attempt < max_retries:
+                logger.warning(
+                    "Lyria request timeout, retrying (attempt %d/%d)",
+                    attempt,
+                    max_retries,
+                )
+                time.sleep(get_retry_delay(attempt))
+                continue
+            raise RuntimeError("Music generation timed out. Using silence instead.")
+        except requests.exceptions.HTTPError as e:
+            error_msg = f"HTTP Error: {e.response.status_code}"
+            if e.response.status_code in (429, 500, 502, 503, 504):
+                # Rate limit (RESOURCE_EXHAUSTED) or transient server error
+                if attempt < max_retries:
+                    logger.warning(
+                        "Lyria returned %d, retrying (attempt %d/%d)",
+                        e.response.status_code,
+                        attempt,
+                        max_retries,
+                    )
+                    time.sleep(get_retry_delay(attempt, e.response))
+                    continue
+                if e.response.status_code == 429:
+                    raise RuntimeError("API rate limit reached. Using silence instead.")
+                raise RuntimeError(f"API Error: {error_msg}")
+            elif e.response.status_code == 403:  # Permission denied
+                raise RuntimeError(
+                    "API access denied. Check your credentials and permissions."
+                )
+            raise RuntimeError(f"API Error: {error_msg}")
+        except Exception as e:
+            if attempt < max_retries:
+                logger.warning(
+                    "Lyria API error, retrying (attempt %d/%d): %s",
+                    attempt,
+                    max_retries,
+                    e,
+                )
+                time.sleep(get_retry_delay(attempt))
+                continue
+            raise RuntimeError(
+                f"Failed to generate music after {max_retries} attempts: {str(e)[:200]}"
+            )
+
+    # Parse response
+    try:
+        data = response.json()
+    except json.JSONDecodeError:
+        raise RuntimeError("Invalid response format from API")
+
+    predictions = data.get("predictions", [])
+    if not predictions:
+        raise RuntimeError("No music generated. Using silence instead.")
+
+    # Decode the predictions to WAV bytes
+    tracks = []
+    for prediction in predictions:
+        try:
+            wav_bytes = decode_prediction_to_wav_bytes(prediction["bytesBase64Encoded"])
+        except (KeyError, binascii.Error) as e:
+            raise RuntimeError(
+                f"Could not decode generated music ({e}). Using silence instead."
+            )
+        tracks.append(wav_bytes)
+    return tuple(tracks)
+
+
+def build_lyria_instance(music_params: dict) -> dict:
+    """
+    Build the Lyria request instance for the user's music preferences.
+    Without a seed, one sample is requested per music page so that every
+    page gets its own track from a single call.
+    """
+    # Create detailed prompt
+    music_prompt, negative_prompt = create_music_prompt(music_params)
+
+    # Prepare request - following official Lyria API format
+    instance = {"prompt": music_prompt}
+
+    # Add negative prompt if provided
+    if negative_prompt.strip():
+        instance["negative_prompt"] = negative_prompt
+
+    # Add seed if provided (for reproducibility)
+    seed = music_params.get("seed")
+    if seed is not None and seed > 0:
+        instance["seed"] = int(seed)
+    else:
+        # Use sample_count instead of seed for variety
+        instance["sample_count"] = len(MUSIC_PAGES)
+
+    return instance
+
+
+def prefetch_music(music_params: dict, max_retries=3):
+    """
+    Start generating the session's music in a background thread, so the
+    Lyria call overlaps with the baseline test and is usually cached by the
+    time the first music page renders.
+    """
+    instance = build_lyria_instance(music_params)
+
+    def warm_cache():
+        try:
+            # Same call shape as load_music, so both hit one cache entry
+            fetch_lyria_audio(instance, max_retries)
+        except Exception:
+            # load_music retries and reports the error on the music page
+            logger.warning("Background music generation failed", exc_info=True)
+
+    thread = threading.Thread(target=warm_cache, daemon=True)
+    add_script_run_ctx(thread, get_script_run_ctx())
+    thread.start()
+
+
+def load_music(music_params: dict, variant=0, max_retries=3):
     """
     Generate music using Lyria API based on user preferences.
     Args:
         music_params (dict): Dictionary containing all music parameters
+        variant (int): Which of the generated tracks to use
     Returns:
         bytes: The audio data in bytes, or None if generation fails.
     """
     try:
-        # Get access token
-        token = get_access_token_for_lyria()
-        if not token:
-            st.error("Failed to authenticate with Lyria API")
-            return create_silent_audio()
-
-        # Create detailed prompt
-        music_prompt, negative_prompt = create_music_prompt(music_params)
+        instance = build_lyria_instance(music_params)
         time.sleep(0.1)
 
         with st.expander("🎵 Music Generation Details", expanded=False):
-            st.write(f"**Main Prompt:** {music_prompt}")
-            st.write(f"**Negative Prompt:** {negative_prompt}")
-
-        # Set up API endpoint
-        project_id = st.secrets["lyria"]["project_id"]
-        endpoint = (
-            f"https://us-central1-aiplatform.googleapis.com/v1/projects/"
-            f"{project_id}/locations/us-central1/publishers/google/models/lyria-002:predict"
-        )
-
-        # Prepare request - following official Lyria API format
-        instance = {"prompt": music_prompt}
-
-        # Add negative prompt if provided
-        if negative_prompt.strip():
-            instance["negative_prompt"] = negative_prompt
-
-        # Add seed if provided (for reproducibility)
-        seed = music_params.get("seed")
-        if seed is not None and seed > 0:
-            instance["seed"] = int(seed)
-        else:
-            # Use sample_count instead of seed for variety
-            instance["sample_count"] = 1
-
-        payload = {"instances": [instance], "parameters": {}}
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Content-Type": "application/json",
-        }
+            st.write(f"**Main Prompt:** {instance['prompt']}")
+            st.write(f"**Negative Prompt:** {instance.get('negative_prompt', '')}")
 
         # Make request with progress indicator
         with st.spinner(
             "🎼 Creating your personalized study music... This may take 30-60 seconds"
         ):
-            for attempt in range(1, max_retries + 1):
-                try:
-                    response = requests.post(
-                        endpoint, headers=headers, json=payload, timeout=120
-                    )
-                    response.raise_for_status()
-                    break
-                except requests.exceptions.Timeout:
-                    if attempt < max_retries:
-                        st.warning(
-                            f"Request timeout, retrying... (attempt {attempt}/{max_retries})"
-                        )
-                        time.sleep(3)
-                        continue
-                    else:
-                        st.error("Music generation timed out. Using silence instead.")
-                        return create_silent_audio()
-                except requests.exceptions.HTTPError as e:
-                    error_msg = f"HTTP Error: {e.response.status_code}"
-                    if e.response.status_code == 429:  # Rate limit
-                        st.error("API rate limit reached. Using silence instead.")
-                    elif e.response.status_code == 403:  # Permission denied
-                        st.error(
-                            "API access denied. Check your credentials and permissions."
-                        )
-                    else:
-                        st.error(f"API Error: {error_msg}")
-                    return create_silent_audio()
-                except Exception as e:
-                    if attempt < max_retries:
-                        st.warning(
-                            f"API error, retrying... (attempt {attempt}/{max_retries}): {str(e)[:100]}"
-                        )
-                        time.sleep(3)
-                        continue
-                    else:
-                        st.error(
-                            f"Failed to generate music after {max_retries} attempts: {str(e)[:200]}"
-                        )
-                        return create_silent_audio()
-
-        # Parse response
-        try:
-            data = response.json()
-            predictions = data.get("predictions", [])
-
-            if not predictions:
-                st.error("No music generated. Using silence instead.")
-                return create_silent_audio()
+            tracks = fetch_lyria_audio(instance, max_retries)
 
-            # Decode the first prediction to WAV bytes
-            pred_bytes_b64 = predictions[0]["bytesBase64Encoded"]
-            wav_bytes = decode_prediction_to_wav_bytes(pred_bytes_b64)
-
-            if wav_bytes:
-                st.success("🎵 Music generated successfully!")
-                return wav_bytes
-            else:
-                return create_silent_audio()
+        st.success("🎵 Music generated successfully!")
+        # A seeded request yields a single track, which every page shares
+        return tracks[variant % len(tracks)]
 
-        except json.JSONDecodeError:
-            st.error("Invalid response format from API")
-            return create_silent_audio()
+    except RuntimeError as e:
+        st.error(str(e))
+        return create_silent_audio()
 
     except Exception as e:
         st.error(f"Unexpected error in music generation: {str(e)[:200]}")
         return create_silent_audio()
 
 
+@st.cache_resource(show_spinner=False)
 def create_silent_audio(duration=30):
     """
     Create a silent audio track as fallback.
+    The track never changes, so it is built once per duration and shared.
     Args:
         duration (int): Duration in seconds
     Returns:
@@ -299,52 +505,121 @@ def create_silent_audio(duration=30):
     """
     try:
         samplerate = 44100  # 44.1kHz
-        # Generate a silent numpy array
-        silent_array = np.zeros(int(samplerate * duration))
-
-        # Use an in-memory bytes buffer
-        buffer = io.BytesIO()
-        write(buffer, samplerate, silent_array.astype(np.int16))
-
-        return buffer.getvalue()
+        # Silence in 16-bit mono PCM is just zero bytes, 2 per sample
+        silent_pcm = bytes(2 * int(samplerate * duration))
+        return encode_wav(silent_pcm, samplerate=samplerate, nchannels=1)
     except Exception as e:
         st.error(f"Error creating silent audio: {e}")
         return b""
 
 
+@st.cache_resource
+def get_firestore_client():
+    """Build the Firestore client once per server process and share it."""
+    firestore_secrets = get_secrets("firestore")
+    creds = service_account.Credentials.from_service_account_info(firestore_secrets)
+    return firestore.Client(credentials=creds, project=firestore_secrets["project_id"])
+
+
 def submit_to_firestore(data: dict):
     """
     Function to submit the final collected data to Google Cloud Firestore.
     This function requires authentication to be set up.
     """
     try:
-        creds = service_account.Credentials.from_service_account_info(
-            st.secrets["firestore"]
-        )
-        db = firestore.Client(
-            credentials=creds, project=st.secrets["firestore"]["project_id"]
-        )
+        db = get_firestore_client()
 
         collection_ref = db.collection("user_responses")
         doc_ref = collection_ref.add(data)
         st.success("Your responses were saved. Thank you! 💻")
         return True
     except Exception as e:
+        logger.exception("Firestore submit failed")
         st.error(f"Failed to submit to Firestore: {str(e)[:200]}")
-        with st.expander("Error Details"):
-            st.code(traceback.format_exc())
         return False
 
 
+@st.cache_resource(show_spinner=False)
+def get_saved_progress() -> tuple:
+    """Progress snapshots by session id and their lock, shared by all sessions."""
+    return {}, threading.Lock()
+
+
+def issue_session_id():
+    """Give the session a fresh id, so an older URL can no longer resume it."""
+    session_id = uuid.uuid4().hex
+    st.query_params["sid"] = session_id
+    st.session_state.session_id = session_id
+
+
+def load_progress(session_id: str) -> dict:
+    """Copy of the saved progress for a session id, or {} if none or expired."""
+    saved, lock = get_saved_progress()
+    with lock:
+        entry = saved.get(session_id)
+        if entry is None:
+            return {}
+        if time.time() - entry["saved_at"] > PROGRESS_TTL_SECONDS:
+            del saved[session_id]
+            return {}
+        # A copy, so tabs restored from the same sid don't share state
+        return copy.deepcopy(entry["state"])
+
+
+def save_progress():
+    """Snapshot the session's progress so reloading the page resumes it."""
+    saved, lock = get_saved_progress()
+    session_id = st.session_state.session_id
+    now = time.time()
+    state = copy.deepcopy(
+        {key: st.session_state[key] for key in PROGRESS_KEYS if key in st.session_state}
+    )
+
+    with lock:
+        # Drop abandoned sessions so the store, and the emails in it, can't
+        # grow with traffic; dicts iterate oldest-saved first
+        for stale_id in [
+            sid
+            for sid, entry in saved.items()
+            if now - entry["saved_at"] > PROGRESS_TTL_SECONDS
+        ]:
+            del saved[stale_id]
+
+        saved.pop(session_id, None)
+        finished = st.session_state.page_number >= 5
+        if not finished:
+            while len(saved) >= PROGRESS_MAX_ENTRIES:
+                del saved[next(iter(saved))]
+            saved[session_id] = {"saved_at": now, "state": state}
+
+    if finished:
+        # The final page submits results, so neither a reload nor the old URL
+        # may land there again
+        issue_session_id()
+
+
 def restart_app():
     """Clear all session state and restart the app."""
-    for key in list(st.session_state.keys()):
-        del st.session_state[key]
+    saved, lock = get_saved_progress()
+    with lock:
+        saved.pop(st.session_state.get("session_id"), None)
+    st.session_state.clear()
+    # The next participant must not be able to resume through this URL
+    issue_session_id()
     st.rerun()
 
 
 # --- STATE INITIALIZATION ---
 
+# A session id in the URL lets a reload pick up the saved progress
+if "session_id" not in st.session_state:
+    session_id = st.query_params.get("sid")
+    if session_id:
+        st.session_state.session_id = session_id
+        st.session_state.update(load_progress(session_id))
+    else:
+        issue_session_id()
+
 # Use session_state to store data across reruns and pages
 if "page_number" not in st.session_state:
     st.session_state.page_number = 1
@@ -500,8 +775,17 @@ def render_page_1():
                 "seed": seed if seed > 0 else None,
             }
 
+            # Generate the music while the user takes the baseline test
+            prefetch_music(st.session_state.music_params)
+
+            # Draw every test page's passage in this run: pops from the
+            # shuffled rotation are distinct, so no two pages repeat
+            for test_page in (2, 3, 4):
+                st.session_state[f"test_content_page_{test_page}"] = load_passage()
+
             # Move to the next page
             st.session_state.page_number = 2
+            save_progress()
             st.rerun()
 
 
@@ -546,7 +830,10 @@ def render_test_page(page_num: int, with_music: bool):
         music_cache_key = f"music_page_{page_num}"
 
         if music_cache_key not in st.session_state.generated_music_cache:
-            audio_bytes = load_music(st.session_state.music_params)
+            audio_bytes = load_music(
+                st.session_state.music_params,
+                variant=MUSIC_PAGES.index(page_num),
+            )
             st.session_state.generated_music_cache[music_cache_key] = audio_bytes
 
         audio_bytes = st.session_state.generated_music_cache[music_cache_key]
@@ -565,35 +852,58 @@ def render_test_page(page_num: int, with_music: bool):
     st.markdown(test_text)
 
     st.divider()
+    render_questions(page_num, question_obj_list, with_music, test_info["title"])
+
+
+@st.fragment
+def render_questions(
+    page_num: int, question_obj_list: list, with_music: bool, test_type: str
+):
+    """
+    Renders a test page's questions and scores them on submit. As a fragment,
+    submitting only reruns this block until the app rerun that advances pages.
+    """
     st.markdown("### ❓ Comprehension Questions")
 
-    # Store answers in a dictionary for this page
-    page_answers = {}
-    for i, question_obj in enumerate(question_obj_list):
-        q = question_obj["text"]
-        page_answers[q] = st.radio(
-            q, ("Yes", "No"), key=f"p{page_num}_q{i}", horizontal=True
-        )
+    # Answers live in a form so toggling a radio doesn't rerun the whole app
+    with st.form(f"test_form_p{page_num}"):
+        # The radios keep their answers in session_state under their keys
+        for i, question_obj in enumerate(question_obj_list):
+            st.radio(
+                question_obj["text"],
+                ("Yes", "No"),
+                index=None,
+                key=f"p{page_num}_q{i}",
+                horizontal=True,
+            )
+
+        submitted = st.form_submit_button("📝 Complete This Section", type="primary")
 
     col1, col2 = st.columns([3, 1])
 
     with col1:
-        if st.button(
-            "📝 Complete This Section", key=f"next_p{page_num}", type="primary"
+        if submitted and any(
+            st.session_state[f"p{page_num}_q{i}"] is None
+            for i in range(len(question_obj_list))
         ):
+            st.warning("Please answer all questions before continuing.")
+        elif submitted:
+            # Store answers in a dictionary for this page
+            page_answers = {
+                question_obj["text"]: st.session_state[f"p{page_num}_q{i}"]
+                for i, question_obj in enumerate(question_obj_list)
+            }
+
             # evaluate the test answers
-            correct_count = 0
-            for question, correct_response in [
-                (question_obj["text"], question_obj["correct_response"])
+            correct_count = sum(
+                page_answers[question_obj["text"]] == question_obj["correct_response"]
                 for question_obj in question_obj_list
-            ]:
-                if page_answers[question] == correct_response:
-                    correct_count += 1
+            )
 
             page_answers["correct_count"] = correct_count
             page_answers["total_questions"] = len(question_obj_list)
             page_answers["had_music"] = with_music
-            page_answers["test_type"] = test_info["title"]
+            page_answers["test_type"] = test_type
 
             # Save this page's answers to the main state
             st.session_state.test_answers[f"page_{page_num}"] = page_answers
@@ -605,9 +915,10 @@ def render_test_page(page_num: int, with_music: bool):
             )
             time.sleep(1.5)
 
-            # Increment page number and rerun
+            # Increment page number and rerun the whole app
             st.session_state.page_number += 1
-            st.rerun()
+            save_progress()
+            st.rerun(scope="app")
 
     with col2:
         if st.button(
@@ -674,14 +985,22 @@ def render_final_page():
                 delta=f"{section['percentage']:.1f}%",
             )
 
+    # Only the results page needs NumPy, so it is imported here rather than
+    # on the pages every participant sees first
+    import numpy as np
+
+    # Average each condition in one vectorized pass; plain floats keep the
+    # Firestore payload free of NumPy types
+    baseline_pcts = np.array([s["percentage"] for s in no_music_sections])
+    music_pcts = np.array([s["percentage"] for s in music_sections])
+    baseline_avg = float(baseline_pcts.mean()) if baseline_pcts.size else 0
+    music_avg = float(music_pcts.mean()) if music_pcts.size else 0
+    difference = (
+        music_avg - baseline_avg if baseline_pcts.size and music_pcts.size else 0
+    )
+
     # Performance comparison
     if no_music_sections and music_sections:
-        baseline_avg = sum([s["percentage"] for s in no_music_sections]) / len(
-            no_music_sections
-        )
-        music_avg = sum([s["percentage"] for s in music_sections]) / len(music_sections)
-        difference = music_avg - baseline_avg
-
         st.markdown("#### 📈 Performance Analysis")
         if difference > 5:
             st.success(
@@ -734,9 +1053,9 @@ def render_final_page():
         "test_answers": st.session_state.test_answers,
         "results_summary": results_summary,
         "performance_analysis": {
-            "baseline_avg": baseline_avg if no_music_sections else 0,
-            "music_avg": music_avg if music_sections else 0,
-            "improvement": difference if (no_music_sections and music_sections) else 0,
+            "baseline_avg": baseline_avg,
+            "music_avg": music_avg,
+            "improvement": difference,
         },
     }
 
@@ -755,8 +1074,23 @@ def render_final_page():
             restart_app()
 
 
+def render_invalid_page():
+    """Renders a reset prompt when page_number matches no page."""
+    st.error("Invalid page state detected.")
+    if st.button("🔄 Reset Application"):
+        restart_app()
+
+
 # --- MAIN APP ROUTER ---
 
+PAGE_RENDERERS = {
+    1: render_page_1,
+    2: partial(render_test_page, page_num=2, with_music=False),
+    3: partial(render_test_page, page_num=3, with_music=True),
+    4: partial(render_test_page, page_num=4, with_music=True),
+    5: render_final_page,
+}
+
 st.set_page_config(
     page_title="Music & Focus Study",
     page_icon="🎵",
@@ -780,21 +1114,7 @@ if st.session_state.page_number <= 5:
 # Error boundary wrapper
 try:
     page = st.session_state.page_number
-
-    if page == 1:
-        render_page_1()
-    elif page == 2:
-        render_test_page(page_num=2, with_music=False)
-    elif page == 3:
-        render_test_page(page_num=3, with_music=True)
-    elif page == 4:
-        render_test_page(page_num=4, with_music=True)
-    elif page == 5:
-        render_final_page()
-    else:
-        st.error("Invalid page state detected.")
-        if st.button("🔄 Reset Application"):
-            restart_app()
+    PAGE_RENDERERS.get(page, render_invalid_page)()
 
 except Exception as e:
     st.error("An unexpected error occurred. Please restart the application.")